@@ -4,13 +4,24 @@ import random
 import string
 import os
 import datetime
+import fcntl
 import time
 import signal
 import psutil
 import shutil
 import yaml
 import json
+import shlex
 import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+SUPERVISOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'supervisor.py')
+DEFAULT_PARALLELISM = 4
+DEFAULT_READY_TIMEOUT = 60
+MULTILOG_SEGMENTS = 100 # rotated segments multilog keeps per stream, archived ones count too
+MULTILOG_SEGMENT_SIZE = 16777215
+KILL_TIMEOUT = 10 # seconds for the supervisor to SIGKILL and reap the service
 
 def mode(filename):
     return oct(os.stat(filename).st_mode & 0o777)[-3:]
@@ -22,7 +33,8 @@ def check_and_create_dir( dst ):
         return False
     if not os.path.isdir( dst ):
         print( "creating dir", dst )
-        os.makedirs( dst )
+        # services may be started concurrently, sharing parent dirs
+        os.makedirs( dst, exist_ok=True )
     return True
 
 def generate_instance_id():
@@ -103,6 +115,11 @@ class Service:
                 self.git = self.config.get("git")
                 self.exit = self.config.get("exit")
                 self.revision = self.config.get("revision")
+                self.supervise = self.config.get("supervise")
+                self.kill_leftovers = self.config.get("kill_leftovers")
+                self.ready = self.config.get("ready")
+                self.ready_timeout = self.config.get("ready_timeout", DEFAULT_READY_TIMEOUT)
+                self.start_delay = self.config.get("start_delay")
                 if not self.instance_id and 'instances' in self.config and len(self.config['instances']):
                     self.instance_id = self.config['instances'][-1]
 
@@ -128,6 +145,11 @@ class Service:
         self.git = None
         self.exit = None
         self.revision = None
+        self.supervise = None
+        self.kill_leftovers = None
+        self.ready = None
+        self.ready_timeout = DEFAULT_READY_TIMEOUT
+        self.start_delay = None
         self.cwd = None
         self.cmd = None
         self.started = None
@@ -193,6 +215,39 @@ class Service:
             return self.start_command()
 
 
+    @with_conf
+    def wait_until_ready(self):
+        # 'ready' is a command that exits 0 once the service accepts work, 'start_delay' a fixed wait
+        if self.ready:
+            w_dir = self.get_working_dir()
+            deadline = time.time() + self.ready_timeout
+            while time.time() < deadline:
+                if not self.is_running():
+                    print( "Service terminated while waiting for readiness:", self.tag )
+                    return False
+                # own session, so a hanging check can be killed with everything it started
+                check = subprocess.Popen(self.ready, cwd=w_dir, shell=True, start_new_session=True,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                try:
+                    if check.wait(timeout=max(deadline - time.time(), 0.1)) == 0:
+                        return True
+                except subprocess.TimeoutExpired:
+                    try:
+                        os.killpg(check.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        # exited just now
+                        pass
+                    check.wait()
+                    continue
+                time.sleep(1)
+            print( "Service not ready after {}s: {}".format(self.ready_timeout, self.tag) )
+            return False
+
+        if self.start_delay:
+            time.sleep(self.start_delay)
+        return self.is_running()
+
+
     @with_conf
     def stop(self):
         # TODO in case of self.exit, check that pid is gone
@@ -202,7 +257,14 @@ class Service:
             w_dir = self.get_working_dir()
             return subprocess.Popen(self.exit, cwd=w_dir, shell=True).wait()
 
-        procs = self.get_procs()
+        if self.instance_config.get('supervised'):
+            # the supervisor forwards the signal to all processes of the service
+            # and only exits once every one of them is reaped
+            root = self.get_root_proc()
+            procs = [root] if root else []
+        else:
+            procs = self.get_procs()
+
         # kill parents first (smaller pid)
         for p in sorted(procs, key=lambda p: p.pid):
             try:
@@ -211,6 +273,8 @@ class Service:
                 print( "Process {} already terminated".format(p.pid) )
 
         processes = psutil.wait_procs(procs, timeout=180)
+        if processes[1] and self.instance_config.get('supervised'):
+            self.kill()
 
         # wait for loggin to terminate as well
         if procs:
@@ -222,6 +286,39 @@ class Service:
         return processes
 
 
+    @with_conf
+    def kill(self):
+        # a supervised instance: the supervisor SIGKILLs all descendants on SIGALRM and reaps them,
+        # so nothing gets re-parented to init. Only if that fails, kill directly.
+        root = self.get_root_proc()
+        if root:
+            try:
+                root.send_signal(signal.SIGALRM)
+                root.wait(timeout=KILL_TIMEOUT)
+                return
+            except psutil.NoSuchProcess:
+                return
+            except psutil.TimeoutExpired:
+                print( "Supervisor did not terminate, killing:", self.instance_id )
+
+        proc_info = self.read_proc_file()
+        if proc_info.get('pgid'):
+            try:
+                os.killpg(proc_info['pgid'], signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        for pid in proc_info.get('descendants', []):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        if root:
+            try:
+                root.kill()
+            except psutil.NoSuchProcess:
+                pass
+
+
     @with_conf
     def wait_for_logging(self, timeout=10):
         run_dir, instance_dir = self.create_run_dirs()
@@ -263,6 +360,18 @@ class Service:
                 return int( pid_string )
 
 
+    def read_proc_file(self):
+        # fresh read, the supervisor updates proc.json after start
+        instance_dir = self.get_instance_dir()
+        if not instance_dir:
+            return {}
+        proc_file = os.path.join( instance_dir, "proc.json" )
+        if not os.path.isfile( proc_file ):
+            return {}
+        with open( proc_file ) as f:
+            return json.loads( f.read() )
+
+
     def get_root_proc(self):
         pid = self.get_pid()
         if not pid:
@@ -279,6 +388,16 @@ class Service:
         if not parent:
             return []
 
+        if self.instance_config.get('supervised'):
+            # the supervisor keeps the exact set of live descendants
+            children = []
+            for pid in self.read_proc_file().get('descendants', []):
+                try:
+                    children += [psutil.Process(pid)]
+                except psutil.NoSuchProcess:
+                    pass
+            return children + [parent]
+
         children = parent.children(recursive=True)
         children += [parent]
         return children
@@ -333,6 +452,8 @@ class Service:
         if run_dir:
             instance_list_file = os.path.join(run_dir, "instances")
             with open( instance_list_file, 'a' ) as f:
+                # logarchiver rewrites it under the same lock
+                fcntl.flock(f, fcntl.LOCK_EX)
                 print( self.instance_id, file=f )
 
         pid_file = os.path.join(instance_dir, "pid")
@@ -342,7 +463,12 @@ class Service:
         proc_file = os.path.join(instance_dir, "proc.json")
         now = datetime.datetime.utcnow().isoformat() + 'Z'
 
-        cmd = self.entry + "; echo $? > " + exit_file
+        if self.supervise:
+            # no shell: the supervisor execs the split entry and records the exit status in proc.json
+            argv = [os.path.expandvars(a) for a in shlex.split(self.entry)]
+            cmd = [sys.executable, SUPERVISOR] + (['--kill-leftovers'] if self.kill_leftovers else []) + [proc_file, '--'] + argv
+        else:
+            cmd = self.entry + "; echo $? > " + exit_file
 
         out_stream = None
         err_stream = None
@@ -358,9 +484,9 @@ class Service:
             # logger / log-rotator
             if shutil.which('multilog'):
                 # FIXME multilog might not be able to open those files if a previous instance is still terminating
-                out_stream = subprocess.Popen(['multilog','t','n100','s16777215',out_file+'.d'],
+                out_stream = subprocess.Popen(['multilog','t','n{}'.format(MULTILOG_SEGMENTS),'s{}'.format(MULTILOG_SEGMENT_SIZE),out_file+'.d'],
                         stdin=subprocess.PIPE).stdin
-                err_stream = subprocess.Popen(['multilog','t','n100','s16777215',err_file+'.d'],
+                err_stream = subprocess.Popen(['multilog','t','n{}'.format(MULTILOG_SEGMENTS),'s{}'.format(MULTILOG_SEGMENT_SIZE),err_file+'.d'],
                         stdin=subprocess.PIPE).stdin
             else:
                 # no rotation ...
@@ -371,15 +497,151 @@ class Service:
                         shell=True,
                         stdin=subprocess.PIPE).stdin
 
-            # actual process spawn
-            process = subprocess.Popen(cmd, cwd=w_dir, shell=True, stdout=out_stream, stderr=err_stream)
-            f.write(str(process.pid))
+            # written before the spawn, the supervisor adds to it
             with open( proc_file, 'w' ) as pf:
                 print( json.dumps({
                     'tag':self.tag,
                     'cwd':w_dir,
-                    'cmd':cmd,
+                    'cmd':' '.join(shlex.quote(a) for a in cmd) if self.supervise else cmd,
                     'entry':self.entry,
+                    'supervised':bool(self.supervise),
                     'started':now
                     }), file=pf )
+
+            # actual process spawn
+            process = subprocess.Popen(cmd, cwd=w_dir, shell=not self.supervise, stdout=out_stream, stderr=err_stream)
+            f.write(str(process.pid))
             return process.pid
+
+
+def get_dependencies( conf, tag ):
+    deps = conf[tag].get('depends_on') or []
+    if isinstance(deps, str):
+        deps = [deps]
+    for dep in deps:
+        if dep not in conf:
+            raise Exception( "unknown dependency {} of {}".format(dep, tag) )
+    return deps
+
+
+def find_cycle( conf, tags ):
+    # depth-first search for a back edge among tags that could not be planned
+    path = []
+    done = set()
+
+    def visit( tag ):
+        if tag in path:
+            return path[path.index(tag):] + [tag]
+        if tag in done:
+            return None
+        path.append(tag)
+        for dep in get_dependencies(conf, tag):
+            if dep in tags:
+                cycle = visit(dep)
+                if cycle:
+                    return cycle
+        path.pop()
+        done.add(tag)
+        return None
+
+    for tag in tags:
+        cycle = visit(tag)
+        if cycle:
+            return cycle
+    return []
+
+
+def plan_startup( conf, tags=None ):
+    # returns waves of tags, each wave only depends on earlier waves.
+    # dependencies of the given tags are pulled in, config order is kept within a wave.
+    if tags is None:
+        tags = list(conf.keys())
+
+    selected = set()
+    todo = list(tags)
+    while todo:
+        tag = todo.pop()
+        if tag in selected:
+            continue
+        if tag not in conf:
+            raise Exception( "unknown tag {}".format(tag) )
+        selected.add(tag)
+        todo += get_dependencies(conf, tag)
+
+    waves = []
+    placed = set()
+    remaining = [tag for tag in conf if tag in selected]
+    while remaining:
+        wave = [tag for tag in remaining if all(dep in placed for dep in get_dependencies(conf, tag))]
+        if not wave:
+            raise Exception( "dependency cycle: {}".format(' -> '.join(find_cycle(conf, remaining))) )
+        waves.append(wave)
+        placed.update(wave)
+        remaining = [tag for tag in remaining if tag not in placed]
+    return waves
+
+
+def print_plan( waves, action="start" ):
+    for i, wave in enumerate(waves):
+        print( "{} wave {}: {}".format(action, i+1, ', '.join(wave)) )
+
+
+def start_waves( conf, waves, parallelism=DEFAULT_PARALLELISM ):
+    # starts each wave concurrently, waits for readiness before starting the next one.
+    # dependents of services that failed to start or didn't get ready are skipped.
+    failed = set()
+
+    def start_service( service ):
+        try:
+            service.start()
+        except Exception as e:
+            print( "Exception starting service", service.tag )
+            print( e )
+            return False
+        return service.is_running()
+
+    def wait_for_service( service ):
+        try:
+            return service.wait_until_ready()
+        except Exception as e:
+            print( "Exception waiting for service", service.tag )
+            print( e )
+            return False
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        for i, wave in enumerate(waves):
+            for tag in wave:
+                missing = [dep for dep in get_dependencies(conf, tag) if dep in failed]
+                if missing:
+                    print( "Skipping {}, dependencies not up: {}".format(tag, ', '.join(missing)) )
+                    failed.add(tag)
+
+            services = [Service(tag=tag) for tag in wave if tag not in failed]
+            was_running = [service.is_running() for service in services]
+            up = list(executor.map(start_service, services))
+            failed.update(service.tag for service, ok in zip(services, up) if not ok)
+
+            if i == len(waves) - 1:
+                break
+            started = [service for service, running, ok in zip(services, was_running, up) if ok and not running]
+            for service, ready in zip(started, executor.map(wait_for_service, started)):
+                if not ready:
+                    failed.add(service.tag)
+    return failed
+
+
+def stop_waves( waves, parallelism=DEFAULT_PARALLELISM ):
+    # stops dependents before their dependencies, i.e. the startup plan reversed
+    def stop_service( service ):
+        try:
+            return service.stop()
+        except Exception as e:
+            print( "Exception stopping service", service.tag )
+            print( e )
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        for wave in reversed(waves):
+            services = [Service(tag=tag) for tag in wave]
+            services = [service for service in services if service.is_running()]
+            for service, result in zip(services, executor.map(stop_service, services)):
+                print( service.tag, result )
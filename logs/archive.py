@@ -0,0 +1,244 @@
+import gzip
+import io
+import json
+import os
+
+# Archived logs are a series of independent gzip members ("blocks") of about BLOCK_SIZE
+# uncompressed bytes each, always ending on a line break. Plain gzip tools read them as one file,
+# the '.idx' sidecar maps uncompressed offsets to the compressed offset of the containing block,
+# so reading can start anywhere without decompressing what's before it.
+#
+# Segments rotated by multilog ('out.log.d/@...s') are archived to 'out.log.archive/', never
+# into the multilog dir itself, as multilog counts and prunes every '@' entry there.
+
+ARCHIVE_EXT='.gz'
+INDEX_EXT='.idx'
+ARCHIVE_DIR_EXT='.archive'
+MULTILOG_DIR_EXT='.d'
+BLOCK_SIZE=1024*1024
+
+
+class BlockGzipFile(gzip.GzipFile):
+    # closes the underlying file as well, it's opened and positioned by open_log()
+    def close(self):
+        fileobj = self.fileobj
+        super().close()
+        if fileobj:
+            fileobj.close()
+
+
+def archive_name(f_name):
+    return f_name + ARCHIVE_EXT
+
+def index_name(archive):
+    return archive + INDEX_EXT
+
+def resolve_log(f_name):
+    # the archive, once the plain file got compressed
+    if not os.path.isfile(f_name) and os.path.isfile(archive_name(f_name)):
+        return archive_name(f_name)
+    return f_name
+
+def is_archive(f_name):
+    return f_name.endswith(ARCHIVE_EXT)
+
+
+def list_segments(f_name):
+    # all parts of a log stream, oldest first: archived segments, multilog segments, the plain log
+    segments = []
+    archive_dir = f_name + ARCHIVE_DIR_EXT
+    if os.path.isdir(archive_dir):
+        segments += [os.path.join(archive_dir, name) for name in os.listdir(archive_dir) if is_archive(name)]
+    multilog_dir = f_name + MULTILOG_DIR_EXT
+    if os.path.isdir(multilog_dir):
+        segments += [os.path.join(multilog_dir, name) for name in os.listdir(multilog_dir)
+                if name.startswith('@') or name == 'current']
+
+    def segment_order(segment):
+        # '@<tai64n>' sorts chronologically, archived or not, 'current' is the newest
+        name = os.path.basename(segment)
+        if is_archive(name):
+            name = name[:-len(ARCHIVE_EXT)]
+        return (name == 'current', name)
+    segments.sort(key=segment_order)
+    plain = resolve_log(f_name)
+    if os.path.isfile(plain):
+        segments += [plain]
+    return segments
+
+
+def compress_file(f_name, dst_dir=None, block_size=BLOCK_SIZE):
+    if dst_dir:
+        os.makedirs(dst_dir, exist_ok=True)
+        archive = archive_name(os.path.join(dst_dir, os.path.basename(f_name)))
+    else:
+        archive = archive_name(f_name)
+    tmp_archive = archive + '.tmp'
+    try:
+        blocks = []
+        size = 0
+        with open(f_name, 'rb') as src, open(tmp_archive, 'wb') as dst:
+            while True:
+                block = src.read(block_size)
+                if not block:
+                    break
+                block += src.readline()
+                blocks += [[size, dst.tell()]]
+                dst.write(gzip.compress(block))
+                size += len(block)
+
+        # keep the time of the last write, retention goes by it
+        stat = os.stat(f_name)
+        os.utime(tmp_archive, (stat.st_atime, stat.st_mtime))
+        with open(index_name(tmp_archive), 'w') as f:
+            print(json.dumps({ 'block_size': block_size, 'size': size, 'blocks': blocks }), file=f)
+        os.utime(index_name(tmp_archive), (stat.st_atime, stat.st_mtime))
+        os.replace(index_name(tmp_archive), index_name(archive))
+        os.replace(tmp_archive, archive)
+    except OSError:
+        for tmp_file in [tmp_archive, index_name(tmp_archive)]:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+        raise
+    try:
+        os.remove(f_name)
+    except FileNotFoundError:
+        # pruned by multilog in the meantime, the archive is complete anyway
+        pass
+    return archive
+
+
+def read_index(archive):
+    try:
+        with open(index_name(archive)) as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def get_log_size(f_name):
+    # uncompressed size
+    if is_archive(f_name):
+        index = read_index(f_name)
+        if index:
+            return index['size']
+        with gzip.open(f_name, 'rb') as f:
+            return f.seek(0, io.SEEK_END)
+    return os.path.getsize(f_name)
+
+
+def open_log(f_name, offset=0):
+    # text handle on a plain or archived log, positioned at the uncompressed offset.
+    # lines are cut at offset, callers that seek should drop the first line.
+    if not is_archive(f_name):
+        fh = open(f_name, 'rb')
+        fh.seek(offset)
+        return io.TextIOWrapper(fh)
+
+    fh = open(f_name, 'rb')
+    index = read_index(f_name) if offset else None
+    skip = offset
+    if index:
+        block_start, block_pos = 0, 0
+        for u_off, c_off in index['blocks']:
+            if u_off > offset:
+                break
+            block_start, block_pos = u_off, c_off
+        fh.seek(block_pos)
+        skip = offset - block_start
+
+    gz = BlockGzipFile(fileobj=fh, mode='rb')
+    if skip:
+        gz.seek(skip)
+    return io.TextIOWrapper(gz)
+
+
+class SegmentedLog():
+    # reads all segments of a log stream as one, following multilog's rotation at the end.
+    # history_bytes: only read that much of the end, None for everything
+    def __init__(self, f_name, history_bytes=None):
+        self.f_name = f_name
+        self.rotating = os.path.isdir(f_name + MULTILOG_DIR_EXT)
+        self.segments = list_segments(f_name)
+        if not self.segments and not self.rotating:
+            raise FileNotFoundError("no log found: {}".format(f_name))
+        self.idx = 0
+        self.fh = None
+        self.ino = None
+
+        offset = 0
+        if history_bytes is not None and self.segments:
+            sizes = [get_log_size(segment) for segment in self.segments]
+            remaining = history_bytes
+            self.idx = len(sizes) - 1
+            while self.idx > 0 and sizes[self.idx] < remaining:
+                remaining -= sizes[self.idx]
+                self.idx -= 1
+            offset = max(0, sizes[self.idx] - remaining)
+
+        if self.segments:
+            self.open_segment(offset)
+            if offset:
+                # drop the line cut in half by seeking
+                self.fh.readline()
+
+    def open_segment(self, offset=0):
+        segment = self.segments[self.idx]
+        try:
+            self.fh = open_log(segment, offset)
+        except FileNotFoundError:
+            # archived in the meantime
+            segment = archive_name(os.path.join(self.f_name + ARCHIVE_DIR_EXT, os.path.basename(segment)))
+            self.fh = open_log(segment, offset)
+        self.ino = os.fstat(self.fh.fileno()).st_ino
+
+    def next_segment(self):
+        if self.idx + 1 >= len(self.segments):
+            if not self.rotating or (self.fh and self.is_current()):
+                return False
+            # multilog renamed the segment we're reading, or it got archived: find it and continue
+            # after it. If it's gone entirely, continue with the newest segment
+            segments = list_segments(self.f_name)
+            if not segments:
+                return False
+            archived = archive_name(os.path.basename(self.segments[self.idx])) if self.segments else None
+            found = len(segments) - 2
+            for i, segment in enumerate(segments):
+                try:
+                    if os.stat(segment).st_ino == self.ino:
+                        found = i
+                        break
+                except OSError:
+                    pass
+            else:
+                for i, segment in enumerate(segments):
+                    if os.path.basename(segment) == archived:
+                        found = i
+                        break
+            self.idx = found
+            self.segments = segments
+            if self.idx + 1 >= len(self.segments):
+                return False
+
+        self.close()
+        self.idx += 1
+        self.open_segment()
+        return True
+
+    def is_current(self):
+        # whether the file we read is still where we opened it, i.e. not rotated
+        try:
+            return os.stat(self.segments[self.idx]).st_ino == self.ino
+        except OSError:
+            return False
+
+    def readline(self):
+        while True:
+            line = self.fh.readline() if self.fh else ''
+            if line or not self.next_segment():
+                return line
+
+    def close(self):
+        if self.fh:
+            self.fh.close()
+            self.fh = None
@@ -4,6 +4,81 @@ import re
 import math
 
 ERROR_RE=re.compile(r'error|fail', re.IGNORECASE)
+ANSI_RE=re.compile(r'\u001b\[([\d;]*)([A-Za-z])')
+
+DEFAULT_MAX_FPS=20
+DEFAULT_SGR=(None, False, False, False) # (fg color, bold, underline, reverse)
+ANSI_COLOR_PAIR_OFFSET=8 # color pairs 8..15 hold the basic ANSI foreground colors
+CUSTOM_COLOR_BASE=16 # first color redefined for the line colors, keeps the ANSI ones intact
+
+def apply_sgr(state, params):
+    fg, bold, underline, reverse = state
+    codes = [int(c) if c else 0 for c in params.split(';')]
+    i = 0
+    while i < len(codes):
+        c = codes[i]
+        if c == 0:
+            fg, bold, underline, reverse = DEFAULT_SGR
+        elif c == 1:
+            bold = True
+        elif c == 4:
+            underline = True
+        elif c == 7:
+            reverse = True
+        elif c == 22:
+            bold = False
+        elif c == 24:
+            underline = False
+        elif c == 27:
+            reverse = False
+        elif 30 <= c <= 37:
+            fg = c - 30
+        elif c == 39:
+            fg = None
+        elif 90 <= c <= 97:
+            fg = c - 90
+            bold = True
+        elif c in (38, 48) and i + 1 < len(codes):
+            # 256-color / true-color is not mapped, just skip its arguments
+            i += 2 if codes[i+1] == 5 else 4
+        i += 1
+    return (fg, bold, underline, reverse)
+
+def parse_ansi(line):
+    # splits a line into (text, sgr-state) segments, dropping the escape sequences
+    segments = []
+    state = DEFAULT_SGR
+    pos = 0
+    for m in ANSI_RE.finditer(line):
+        if m.start() > pos:
+            segments.append((line[pos:m.start()], state))
+        if m.group(2) == 'm':
+            state = apply_sgr(state, m.group(1))
+        pos = m.end()
+    if pos < len(line):
+        segments.append((line[pos:], state))
+    return segments
+
+def prepare_line(l):
+    # done once at ingest, so render() doesn't have to parse every visible line again
+    segments = parse_ansi(l.get('line', ''))
+    l['segments'] = segments
+    l['text'] = ''.join(text for text, _ in segments)
+    l['error'] = bool(ERROR_RE.search(l['text']))
+    l['ts'] = {}
+    return l
+
+def clip_segments(segments, start, width):
+    clipped = []
+    pos = 0
+    for text, attr in segments:
+        end = pos + len(text)
+        if end > start and pos < start + width:
+            clipped.append((text[max(start - pos, 0):start + width - pos], attr))
+        pos = end
+        if pos >= start + width:
+            break
+    return tuple(clipped)
 
 def pretty_timediff(t_delta):
     s = t_delta.total_seconds()
@@ -33,7 +108,15 @@ def pretty_timediff(t_delta):
     return "{:>22s}".format(f_str)
 
 class CursedViewer():
-    def __init__(self):
+    def __init__(self, max_fps=DEFAULT_MAX_FPS):
+        self.max_fps = max_fps
+        self.drawn_rows = []
+        self.attr_cache = {}
+        self.filter_key = None
+        self.filtered_lines = []
+        self.filtered_count = 0
+        self.ansi_colors = False
+        self.redefined_colors = set()
         self.stdscr = None
         self.scroll_pos = None
         self.date_mode = None
@@ -51,13 +134,26 @@ class CursedViewer():
         self.stdscr.keypad(True)
         self.stdscr.nodelay(True)
         curses.start_color()
+        # colors for stdout / errors / stderr, redefined above the ANSI ones if possible
+        line_colors = [3, 4, 5]
+        self.redefined_colors = set()
         if curses.can_change_color():
-            curses.init_color(3, 0, 900, 600)
-            curses.init_color(4, 900, 900, 0)
-            curses.init_color(5, 900, 600, 0)
-        curses.init_pair(1, 3, curses.COLOR_BLACK)
-        curses.init_pair(2, 4, curses.COLOR_BLACK)
-        curses.init_pair(3, 5, curses.COLOR_BLACK)
+            if curses.COLORS >= CUSTOM_COLOR_BASE + 3:
+                line_colors = [CUSTOM_COLOR_BASE + i for i in range(0, 3)]
+            else:
+                self.redefined_colors = set(line_colors)
+            curses.init_color(line_colors[0], 0, 900, 600)
+            curses.init_color(line_colors[1], 900, 900, 0)
+            curses.init_color(line_colors[2], 900, 600, 0)
+        curses.init_pair(1, line_colors[0], curses.COLOR_BLACK)
+        curses.init_pair(2, line_colors[1], curses.COLOR_BLACK)
+        curses.init_pair(3, line_colors[2], curses.COLOR_BLACK)
+        self.ansi_colors = curses.COLOR_PAIRS >= ANSI_COLOR_PAIR_OFFSET + 8
+        if self.ansi_colors:
+            # no pair for black, it'd be invisible on the black background
+            for c in range(1, 8):
+                curses.init_pair(ANSI_COLOR_PAIR_OFFSET + c, c, curses.COLOR_BLACK)
+        self.invalidate()
         return self
 
     def __exit__(self, type, value, traceback):
@@ -73,82 +169,153 @@ class CursedViewer():
         print('colors', curses.COLORS)
 
 
+    def matches_filter(self, l):
+        if self.filter and l.get('type') != self.filter:
+            return False
+        if self.search_string and self.search_string not in l.get('text', l.get('line', '')):
+            return False
+        return True
+
     def get_filtered_lines(self,lines):
         if not self.filter and not self.search_string:
             return lines
 
-        # TODO maybe filter backwards until number of lines == curses.LINES ?)
-        stage_1 = [l for l in lines if not self.filter or l.get('type') == self.filter]
-        stage_2 = [l for l in stage_1 if not self.search_string or self.search_string in l.get('line', '')]
-        return stage_2
+        # lines are only ever appended: filter the new ones, start over when the filter changes
+        filter_key = (self.filter, self.search_string)
+        if filter_key != self.filter_key or self.filtered_count > len(lines):
+            self.filter_key = filter_key
+            self.filtered_lines = []
+            self.filtered_count = 0
+        self.filtered_lines += [l for l in lines[self.filtered_count:] if self.matches_filter(l)]
+        self.filtered_count = len(lines)
+        return self.filtered_lines
+
+    def invalidate(self):
+        # forget what's on screen, next render() redraws every row
+        self.drawn_rows = []
+
+    def line_attr(self, l):
+        flag = 0
+        if l.get('type') == 'stdout':
+            flag = curses.color_pair(1)
+        if l.get('error'):
+            flag = curses.color_pair(2)
+        if l.get('type') == 'stderr':
+            flag = curses.color_pair(3)
+        return flag
+
+    def segment_attr(self, base, state):
+        if state == DEFAULT_SGR:
+            return base
+        key = (base, state)
+        if key not in self.attr_cache:
+            fg, bold, underline, reverse = state
+            attr = base
+            # black and colors redefined for the line colors would show up wrong, keep the line's color then
+            if fg and self.ansi_colors and fg not in self.redefined_colors:
+                attr = curses.color_pair(ANSI_COLOR_PAIR_OFFSET + fg)
+            if bold:
+                attr |= curses.A_BOLD
+            if underline:
+                attr |= curses.A_UNDERLINE
+            if reverse:
+                attr |= curses.A_REVERSE
+            self.attr_cache[key] = attr
+        return self.attr_cache[key]
+
+    def format_ts(self, l, now):
+        d = l.get('date')
+        if not self.date_mode or not d:
+            return ''
+        if self.date_mode == 'diff':
+            # changes with every frame, not worth caching
+            return pretty_timediff(now - d) + ' | '
+
+        ts_cache = l.setdefault('ts', {})
+        if self.date_mode not in ts_cache:
+            if self.date_mode == 'sec':
+                ts = d.strftime('%s')
+            elif self.date_mode == 'utc':
+                ts = d.isoformat(sep=' ', timespec='milliseconds')
+            ts_cache[self.date_mode] = ts + ' | '
+        return ts_cache[self.date_mode]
+
+    def get_status_bar(self):
+        status_bar = []
+        if self.filter:
+            status_bar += [self.filter]
+        if self.scroll_pos:
+            status_bar += ['scrolling']
+        elif self.scroll_pos == 0:
+            status_bar += ['top']
+        if self.wrap:
+            status_bar += [self.wrap]
+        if self.search_string:
+            status_bar += ['search: ' + self.search_string]
 
-    def render(self, content):
+        if status_bar:
+            return ' ' + ' | '.join(status_bar) + ' '
+        return ''
+
+    def get_rows(self, content):
+        # screen content as one tuple of (text, attr) segments per row
         lines = self.get_filtered_lines(content.lines)
         idx_start = max(0, len(lines) - curses.LINES) if self.scroll_pos == None else self.scroll_pos
-        self.stdscr.erase()
         now = datetime.now()
 
+        rows = []
         i = 0
-        i_screen = 0
-        while i < min(len(lines) - idx_start, curses.LINES) and i_screen < curses.LINES:
-            # |curses.A_BOLD|curses.A_BLINK
+        while i < min(len(lines) - idx_start, curses.LINES) and len(rows) < curses.LINES:
             l = lines[idx_start+i]
+            if 'segments' not in l:
+                prepare_line(l)
 
-            flag = None
-            if l.get('type') == 'stdout':
-                flag = curses.color_pair(1)
-            if ERROR_RE.search(l.get('line', '')):
-                flag = curses.color_pair(2)
-            if l.get('type') == 'stderr':
-                flag = curses.color_pair(3)
-
-            ts = ''
-            d = l.get('date')
-            if self.date_mode and d:
-                if self.date_mode == 'sec':
-                    ts = d.strftime('%s')
-                elif self.date_mode == 'utc':
-                    ts = d.isoformat(sep=' ', timespec='milliseconds')
-                elif self.date_mode == 'diff':
-                    diff = now - d
-                    ts = pretty_timediff(diff)
-                ts += ' | '
-
-            msg = ts + l.get("line", '')
-            # TODO preserve colors
-            msg = re.sub('\u001b\[\d+(;\d)?m', '', msg)
-            try:
-                if self.wrap:
-                    num_msg_lines = math.ceil(len(msg) / curses.COLS)
-                    for l_i in range(0, num_msg_lines):
-                        i_screen += 1
-                        self.stdscr.addstr(i_screen-1, 0, msg[(l_i*curses.COLS):((l_i+1)*curses.COLS)], flag)
-                        #self.stdscr.addstr(i_screen-1, 0, str(i_screen), flag)
-                else:
-                    i_screen += 1
-                    self.stdscr.addstr(i_screen-1, 0, msg[:curses.COLS], flag)
-            except Exception as e:
-                self.debug = e
+            flag = self.line_attr(l)
+            segments = [(self.format_ts(l, now), flag)]
+            segments += [(text, self.segment_attr(flag, state)) for text, state in l['segments']]
+
+            if self.wrap:
+                msg_len = sum(len(text) for text, _ in segments)
+                num_msg_lines = max(math.ceil(msg_len / curses.COLS), 1)
+                for l_i in range(0, num_msg_lines):
+                    rows.append(clip_segments(segments, l_i*curses.COLS, curses.COLS))
+            else:
+                rows.append(clip_segments(segments, 0, curses.COLS))
 
             i += 1
 
+        rows = rows[:curses.LINES]
+        status_bar = self.get_status_bar()
+        if status_bar:
+            rest = clip_segments(rows[0], len(status_bar), curses.COLS) if rows else ()
+            rows[0:1] = [((status_bar[:curses.COLS], 0),) + rest]
+        return rows
+
+    def draw_row(self, y, row):
+        self.stdscr.move(y, 0)
+        self.stdscr.clrtoeol()
+        x = 0
+        for text, attr in row:
+            if not text:
+                continue
+            try:
+                self.stdscr.addstr(y, x, text, attr)
+            except Exception as e:
+                # writing the bottom right corner raises, although it's drawn
+                self.debug = e
+            x += len(text)
 
+    def render(self, content):
+        rows = self.get_rows(content)
 
-        status_bar = []
-        if self.filter:
-            status_bar += [self.filter]
-        if self.scroll_pos:
-            status_bar += ['scrolling']
-        elif self.scroll_pos == 0:
-            status_bar += ['top']
-        if self.wrap:
-            status_bar += [self.wrap]
-            #status_bar += [str(i),str(i_screen)]
-        if self.search_string:
-            status_bar += ['search: ' + self.search_string]
+        # only touch the rows that changed since the last frame
+        for y in range(0, curses.LINES):
+            row = rows[y] if y < len(rows) else ()
+            drawn = self.drawn_rows[y] if y < len(self.drawn_rows) else None
+            if row != drawn:
+                self.draw_row(y, row)
 
-        if status_bar:
-            self.stdscr.addstr(0, 0, ' ' + ' | '.join(status_bar) + ' ')
+        self.drawn_rows = rows + [()] * (curses.LINES - len(rows))
         self.stdscr.refresh()
 
 
@@ -226,6 +393,8 @@ class CursedViewer():
 
             if c == curses.KEY_RESIZE:
                 curses.update_lines_cols()
+                self.stdscr.clear()
+                self.invalidate()
 
             c = self.stdscr.getch()
         return events
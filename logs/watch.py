@@ -2,7 +2,8 @@ import os
 import time
 from datetime import datetime, timedelta
 import re
-from logs.viewer import CursedViewer
+from logs.viewer import CursedViewer, prepare_line
+from logs.archive import SegmentedLog, list_segments
 
 
 LOG_DATE_RE=re.compile(r'(^|\|\s*)[A-Z]+\s+(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z)') # DEBUG 2020-04-01T11:35:21.460Z |
@@ -12,6 +13,9 @@ DATE_PARSE="%b %d %H:%M:%S"
 TS2_DATE_RE=re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(\.\d+)?Z ?(.*)') # 2020-04-01T11:35:21.460Z
 DATE_PARSE_2="%Y-%m-%dT%H:%M:%S"
 
+TAI64N_RE=re.compile(r'^@([0-9a-f]{16})([0-9a-f]{8}) ?(.*)') # multilog's 't': @400000005e847b2d1b7b9f44
+TAI64_EPOCH=2**62 + 10 # TAI64 label of 1970-01-01 (ignoring leap seconds since)
+
 
 class LogFileTailer():
     def __init__(self, files):
@@ -20,7 +24,7 @@ class LogFileTailer():
     def __enter__(self):
         for f in self.files:
             try:
-                f["fh"] = open(f["f_name"])
+                f["fh"] = SegmentedLog(f["f_name"], f.get("history_bytes"))
             except Exception as e:
                 print('ignoring file {}:'.format(f.get("f_name")), e)
         return self
@@ -47,6 +51,7 @@ class LogFileTailer():
                     if m: 
                         pass
                     m = TS2_DATE_RE.match(line)
+                    m_tai = TAI64N_RE.match(line) if not m else None
                     if m:
                         l = m.group(3)
                         d = datetime.strptime(m.group(1), DATE_PARSE_2).replace(year=f["last_time"].year)
@@ -54,6 +59,9 @@ class LogFileTailer():
                             seconds = float("0" + m.group(2))
                             d += timedelta(seconds=seconds)
                         yield { 'line': l, 'date': d, 'type': f['type'], 'instance': f['f_name'] }
+                    elif m_tai:
+                        d = datetime.utcfromtimestamp(int(m_tai.group(1), 16) - TAI64_EPOCH + int(m_tai.group(2), 16) / 1e9)
+                        yield { 'line': m_tai.group(3), 'date': d, 'type': f['type'], 'instance': f['f_name'] }
                     else:
                         yield { 'line': line, 'type': f['type'], 'instance': f['f_name'], 'date': f['last_time'] }
                     line = f["fh"].readline().strip()
@@ -67,48 +75,61 @@ class LogFileTailer():
 
 
 class LogFilter():
-    def __init__(self):
+    def __init__(self, history_bytes=None):
+        # history_bytes: only read that much of the end of each file, None for everything
+        self.history_bytes = history_bytes
         self.files = []
         self.lines = []
 
-    def add_stdout(self, f_name):
-        if os.path.isfile(f_name):
-            base_time = datetime.fromtimestamp(os.path.getctime(f_name))
+    def add_file(self, f_name, f_type):
+        # all segments of the stream are read, archived ones transparently
+        segments = list_segments(f_name)
+        if segments:
+            base_time = datetime.fromtimestamp(os.path.getctime(segments[0]))
         else:
             base_time = datetime.utcnow()
-        self.files += [{ "f_name": f_name, "type": "stdout", 'last_time': base_time }]
+        self.files += [{ "f_name": f_name, "type": f_type, 'last_time': base_time, 'history_bytes': self.history_bytes }]
+
+    def add_stdout(self, f_name):
+        self.add_file(f_name, "stdout")
 
     def add_stderr(self, f_name):
-        if os.path.isfile(f_name):
-            base_time = datetime.fromtimestamp(os.path.getctime(f_name))
-        else:
-            base_time = datetime.utcnow()
-        self.files += [{ "f_name": f_name, "type": "stderr" , 'last_time': base_time }]
+        self.add_file(f_name, "stderr")
 
     def show(self):
-        err = None
         keep_looping = True
-        do_update = False
+        dirty = True
+        last_render = 0
 
         with LogFileTailer(self.files) as tailer:
             with CursedViewer() as cursed_viewer:
+                frame_interval = 1.0 / cursed_viewer.max_fps
                 while keep_looping:
                     events = cursed_viewer.process_events(self)
                     if 'quit' in events:
                         break
 
                     if 'update' in events:
-                        do_update = True
-                    else:
-                        do_update = False
+                        dirty = True
 
                     new_lines = []
                     for line in tailer.new_lines():
-                        new_lines += [line]
+                        new_lines += [prepare_line(line)]
 
-                    if new_lines or do_update:
+                    if new_lines:
                         new_lines.sort(key=lambda d: d['date'])
                         self.lines += new_lines
+                        dirty = True
+
+                    # cap the frame rate, lines arriving in between are rendered with the next frame
+                    now = time.monotonic()
+                    if dirty and now - last_render >= frame_interval:
                         cursed_viewer.render(self)
-                    else:
+                        last_render = now
+                        dirty = False
+                    elif dirty:
+                        # frame held back: wait for its deadline, the lines arriving meanwhile
+                        # are read as one batch then
+                        time.sleep(frame_interval - (now - last_render))
+                    elif not new_lines:
                         time.sleep(0.1)
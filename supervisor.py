@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+# Minimal supervisor for a single service instance:
+# - becomes a child subreaper, so orphaned grandchildren are re-parented to it instead of init
+# - execs the entry directly (no shell) in its own process group
+# - records pid, process group, the live descendants, exit status and rusage (from wait4)
+#   in the instance's proc.json
+# - forwards stop signals to the process group and all descendants and reaps everything before
+#   exiting, so "supervisor alive" means "some process of the service alive"
+# - SIGALRM SIGKILLs all descendants
+# - with --kill-leftovers, processes still around when the entry exits are terminated
+#   (otherwise e.g. a daemonized service keeps running, and so does the supervisor)
+
+import argparse
+import ctypes
+import datetime
+import json
+import os
+import signal
+import sys
+
+PR_SET_CHILD_SUBREAPER = 36
+KILL_TIMEOUT = 10 # seconds between SIGTERM and SIGKILL for leftovers
+REFRESH_INTERVAL = 1 # seconds between refreshes of the descendant set
+FORWARD_SIGNALS = [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT]
+
+child_pid = None
+pending_signal = None
+
+
+def set_child_subreaper():
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) != 0:
+        print("supervisor: PR_SET_CHILD_SUBREAPER failed:", os.strerror(ctypes.get_errno()), file=sys.stderr)
+        return False
+    return True
+
+
+def update_proc_file(proc_file, **values):
+    info = {}
+    if os.path.isfile(proc_file):
+        with open(proc_file, 'r') as f:
+            info = json.loads(f.read())
+    info.update(values)
+    tmp_file = proc_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        print(json.dumps(info), file=f)
+    os.replace(tmp_file, proc_file)
+
+
+def get_descendants():
+    # walks our own process tree via the children lists of its tasks,
+    # re-parented orphans included as we are their subreaper
+    pids = set()
+    todo = [os.getpid()]
+    while todo:
+        pid = todo.pop()
+        try:
+            tids = os.listdir('/proc/{}/task'.format(pid))
+        except OSError:
+            continue
+        for tid in tids:
+            try:
+                with open('/proc/{}/task/{}/children'.format(pid, tid)) as f:
+                    children = [int(c) for c in f.read().split()]
+            except OSError:
+                continue
+            for c in children:
+                if c not in pids:
+                    pids.add(c)
+                    todo.append(c)
+    return pids
+
+
+def signal_all(sig):
+    if child_pid is None:
+        return
+    try:
+        os.killpg(child_pid, sig)
+    except ProcessLookupError:
+        pass
+    # processes that left the process group
+    for pid in get_descendants():
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+
+def forward_signal(signum, frame):
+    global pending_signal
+    if child_pid is None:
+        pending_signal = signum
+        return
+    signal_all(signum)
+
+
+def kill_all(signum, frame):
+    signal_all(signal.SIGKILL)
+
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def add_rusage(total, ru):
+    total['utime'] = total.get('utime', 0) + ru.ru_utime
+    total['stime'] = total.get('stime', 0) + ru.ru_stime
+    total['maxrss'] = max(total.get('maxrss', 0), ru.ru_maxrss)
+    total['minflt'] = total.get('minflt', 0) + ru.ru_minflt
+    total['majflt'] = total.get('majflt', 0) + ru.ru_majflt
+    total['nvcsw'] = total.get('nvcsw', 0) + ru.ru_nvcsw
+    total['nivcsw'] = total.get('nivcsw', 0) + ru.ru_nivcsw
+    return total
+
+
+def spawn(argv):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setpgid(0, 0)
+            signal.pthread_sigmask(signal.SIG_SETMASK, [])
+            for sig in FORWARD_SIGNALS + [signal.SIGALRM]:
+                signal.signal(sig, signal.SIG_DFL)
+            os.execvp(argv[0], argv)
+        except OSError as e:
+            print("supervisor: failed to exec {}: {}".format(argv[0], e), file=sys.stderr)
+        os._exit(127)
+
+    try:
+        # also set it from the parent, so there's no window where killpg misses the child
+        os.setpgid(pid, pid)
+    except OSError:
+        pass
+    return pid
+
+
+def reap(rusage):
+    # collects all exited children, returns (child exit code or None, whether children are left)
+    code = None
+    while True:
+        try:
+            pid, status, ru = os.wait4(-1, os.WNOHANG)
+        except ChildProcessError:
+            return code, False
+        if pid == 0:
+            return code, True
+        add_rusage(rusage, ru)
+        if pid == child_pid:
+            code = exit_code(status)
+
+
+def supervise(proc_file, argv, kill_leftovers=False):
+    global child_pid
+
+    set_child_subreaper()
+    for sig in FORWARD_SIGNALS:
+        signal.signal(sig, forward_signal)
+    signal.signal(signal.SIGALRM, kill_all)
+    # SIGCHLD is only waited for, see sigtimedwait below
+    signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGCHLD])
+
+    child_pid = spawn(argv)
+    update_proc_file(proc_file, supervisor=os.getpid(), pid=child_pid, pgid=child_pid, descendants=[child_pid])
+    if pending_signal:
+        signal_all(pending_signal)
+
+    code = None
+    rusage = {}
+    descendants = set([child_pid])
+    while True:
+        child_code, children_left = reap(rusage)
+        if child_code is not None:
+            code = child_code
+            update_proc_file(proc_file, exit=code)
+            if kill_leftovers:
+                signal_all(signal.SIGTERM)
+                signal.alarm(KILL_TIMEOUT)
+        if not children_left:
+            break
+
+        current = get_descendants()
+        if current != descendants:
+            descendants = current
+            update_proc_file(proc_file, descendants=sorted(descendants))
+        signal.sigtimedwait([signal.SIGCHLD], REFRESH_INTERVAL)
+
+    signal.alarm(0)
+    update_proc_file(proc_file, exit=code, rusage=rusage, descendants=[],
+            ended=datetime.datetime.utcnow().isoformat() + 'Z')
+    return code
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="supervise a single cakestack service instance")
+    parser.add_argument("proc_file", help="the instance's proc.json to record pid, exit status and rusage in")
+    parser.add_argument("--kill-leftovers", help="terminate remaining processes once the entry exits", action="store_true")
+    parser.add_argument("argv", nargs=argparse.REMAINDER, help="command to run, after '--'")
+    args = parser.parse_args()
+    if args.argv and args.argv[0] == '--':
+        args.argv = args.argv[1:]
+    if not args.argv:
+        parser.error("no command given")
+    return args
+
+
+if __name__ == "__main__":
+    args = get_args()
+    code = supervise(args.proc_file, args.argv, kill_leftovers=args.kill_leftovers)
+    if code is None:
+        sys.exit(1)
+    sys.exit(128 - code if code < 0 else code)